@@ -1,29 +1,67 @@
 import os
-import urllib.request
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util.retry import Retry
 
 
-class DownloadProgressBar(tqdm):
-    def update_to(self, b=1, bsize=1, tsize=None):
-        if tsize is not None:
-            self.total = tsize
-        self.update(b * bsize - self.n)
+# shared between downloads, so that connections are kept alive and reused
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                                       max_retries=Retry(total=5, backoff_factor=0.3)))
 
 
-def download_url(url, output_path):
-    with DownloadProgressBar(unit='B', unit_scale=True,
-                             miniters=1, desc=url.split('/')[-1]) as t:
-        urllib.request.urlretrieve(
-            url, filename=output_path, reporthook=t.update_to)
+def download_url(url, output_path, position=None):
+    # write to a temporary file, so that an interrupted download is not taken for a complete one
+    partial_path = f'{output_path}.part'
 
+    with _SESSION.get(url, stream=True, timeout=30) as r:
+        r.raise_for_status()
+        total = int(r.headers.get('content-length', 0)) or None
+        with tqdm(unit='B', unit_scale=True, miniters=1 << 20, mininterval=0.25, total=total,
+                  desc=url.split('/')[-1], position=position) as t, open(partial_path, 'wb', buffering=1 << 20) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            # the progress bar is updated once per MiB, not once per socket read
+            pending = 0
+            for chunk in r.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+                pending += len(chunk)
+                if pending >= 1 << 20:
+                    t.update(pending)
+                    pending = 0
+            t.update(pending)
+            if hasattr(os, 'posix_fadvise'):
+                # the file is only read later, do not let it evict the page cache. Dirty pages are
+                # not dropped, so the data is written back first (without the metadata of fsync).
+                f.flush()
+                os.fdatasync(f.fileno())
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
 
-def download_data(data_path, url_path, suffix):
-    if not os.path.exists(data_path):
-        os.makedirs(data_path)
+    os.replace(partial_path, output_path)
+
+
+def download_data(data_path, url_path, suffix, position=None):
+    os.makedirs(data_path, exist_ok=True)
 
     data_path = os.path.join(data_path, f'{suffix}.json')
 
     if not os.path.exists(data_path):
-        print(f"Downloading CoQA {suffix} data split... (it may take a while)")
-        download_url(url=url_path, output_path=data_path)
-        print("Download completed!")
+        # tqdm.write does not break the progress bars of concurrent downloads
+        tqdm.write(f"Downloading CoQA {suffix} data split... (it may take a while)")
+        download_url(url=url_path, output_path=data_path, position=position)
+        tqdm.write(f"Download of the CoQA {suffix} data split completed!")
+
+
+def download_all(data_path, url_map):
+    """Download concurrently several data splits, given as a mapping from suffix to url."""
+    if not url_map:
+        return
+
+    # each download gets its own line for the progress bar
+    with ThreadPoolExecutor(max_workers=len(url_map)) as executor:
+        futures = [executor.submit(download_data, data_path, url_path, suffix, position)
+                   for position, (suffix, url_path) in enumerate(url_map.items())]
+        for future in futures:
+            future.result()
@@ -1,14 +1,53 @@
-from allennlp_models.rc.tools import squad
+import collections
+import re
+import string
+
+import numpy as np
+
+# same normalization as the official SQuAD evaluation script, see ``utils/evaluate_v2.py``
+_ARTICLES = re.compile(r'\b(a|an|the)\b', re.UNICODE)
+_PUNCTUATION = str.maketrans('', '', string.punctuation)
+
+
+def _get_tokens(s):
+    """Lower text, remove punctuation and articles and split on whitespace."""
+    return _ARTICLES.sub(' ', s.lower().translate(_PUNCTUATION)).split()
+
+
+def _compute_f1_batch(preds, refs):
+    """SQuAD F1 score between each prediction and the corresponding reference."""
+    scores = []
+    for pred, ref in zip(preds, refs):
+        pred_toks = _get_tokens(pred)
+        ref_toks = _get_tokens(ref)
+        if not pred_toks or not ref_toks:
+            # If either is no-answer, then F1 is 1 if they agree, 0 otherwise
+            scores.append(float(pred_toks == ref_toks))
+            continue
+
+        num_same = sum((collections.Counter(pred_toks) & collections.Counter(ref_toks)).values())
+        if num_same == 0:
+            scores.append(0.0)
+            continue
+
+        precision = num_same / len(pred_toks)
+        recall = num_same / len(ref_toks)
+        scores.append(2 * precision * recall / (precision + recall))
+    return scores
+
 
 def compute_metrics(pred, tokenizer):
     """Training metrics for sequence-to-sequence encoder-decoder.
     The tokenizer must be fixed, e.g. using ``functools.partial``."""
-    labels_ids = pred.label_ids
+    assert tokenizer.is_fast, "a fast tokenizer is required"
+    # the ignored positions are replaced by padding in a new array, leaving the caller's untouched
+    labels_ids = np.asarray(pred.label_ids)
+    labels_ids = np.where(labels_ids == -100, tokenizer.pad_token_id, labels_ids).astype(np.int64, copy=False)
     pred_ids = pred.predictions
 
-    # all unnecessary tokens are removed
-    pred_str = tokenizer.batch_decode(pred_ids, skip_special_tokens=True)
-    labels_ids[labels_ids == -100] = tokenizer.pad_token_id
-    label_str = tokenizer.batch_decode(labels_ids, skip_special_tokens=True)
+    # all unnecessary tokens are removed. The spaces around punctuation are not cleaned up, since
+    # the punctuation is removed anyway when computing the F1 score.
+    pred_str = tokenizer.batch_decode(pred_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+    label_str = tokenizer.batch_decode(labels_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
 
-    return squad.compute_f1(pred_str, label_str)
+    return {"f1": float(np.mean(_compute_f1_batch(pred_str, label_str)))}
@@ -1,3 +1,19 @@
+import contextlib
+import hashlib
+import os
+from functools import partial
+
+import numpy as np
+from datasets import DatasetDict
+from datasets.fingerprint import Hasher
+from tokenizers import normalizers
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
 def prepare_train_features_span(examples, tokenizer, max_length=380, doc_stride=128):
     """Tokenize our examples with truncation and padding, but keep the overflows using a
     stride.
@@ -12,8 +28,10 @@ def prepare_train_features_span(examples, tokenizer, max_length=380, doc_stride=
     Parameters
     ----------
     examples : datasets.Dataset
-    tokenizer : transformers.PreTrainedTokenizer | transformers.PreTrainedTokenizerFast
-        pretrained tokenizer for the model for which to use the features.
+    tokenizer : transformers.PreTrainedTokenizerFast
+        pretrained tokenizer for the model for which to use the features. It must be a fast
+        (Rust-backed) tokenizer, e.g. loaded with ``AutoTokenizer.from_pretrained(..., use_fast=True)``,
+        passed to ``add_leading_strip`` so that the leading whitespace of the inputs is ignored.
     max_length : int, optional
         maximum length of the tokenization, by default 380.
     doc_stride : int, optional
@@ -29,12 +47,11 @@ def prepare_train_features_span(examples, tokenizer, max_length=380, doc_stride=
          - ``'start_positions'``: index of the starting token of the answer span
          - ``'end_positions'``: index of the final token of the answer span
     """
-    question = [q.lstrip() for q in examples["question"]]
-    story = [c.lstrip() for c in examples["story"]]
+    assert tokenizer.is_fast, "a fast tokenizer is required"
 
     tokenized_examples = tokenizer(
-        question,
-        story,
+        examples["question"],
+        examples["story"],
         truncation="only_second",
         max_length=max_length,
         stride=doc_stride,
@@ -45,63 +62,114 @@ def prepare_train_features_span(examples, tokenizer, max_length=380, doc_stride=
 
     # Since one example might give us several features if it has a long context, we need a
     # map from a feature to its corresponding example. This key gives us just that.
-    sample_mapping = tokenized_examples.pop("overflow_to_sample_mapping")
+    sample_mapping = np.asarray(tokenized_examples.pop("overflow_to_sample_mapping"))
     # The offset mappings will give us a map from token to character position in the original
     # context. This will help us compute the start_positions and end_positions.
-    offset_mapping = tokenized_examples.pop("offset_mapping")
+    offsets = np.asarray(tokenized_examples.pop("offset_mapping"), dtype=np.int32)
+
+    # We will label impossible answers with the index of the CLS token, which is the first
+    # token for the models we use.
+    assert tokenized_examples["input_ids"][0].index(tokenizer.cls_token_id) == 0
+    cls_index = np.zeros(len(offsets), dtype=np.int64)
+
+    # Mask of the tokens belonging to the context (to know what is the context and what is the
+    # question). The sequence ids are read once per feature, straight from the Rust encodings,
+    # and compared in a single pass: special tokens have sequence id ``None``, which becomes NaN.
+    # ``token_type_ids`` cannot be used instead, since not all models (e.g. RoBERTa) return them.
+    sequence_ids = np.array(
+        [encoding.sequence_ids for encoding in tokenized_examples.encodings], dtype=np.float64
+    )
+    context_mask = sequence_ids == 1
+
+    # Start/end character index of the answer in the text, for each feature.
+    start_char = np.asarray(examples["span_start"], dtype=np.int64)[sample_mapping]
+    end_char = np.asarray(examples["span_end"], dtype=np.int64)[sample_mapping]
 
     # Let's label those examples!
-    tokenized_examples["start_positions"] = []
-    tokenized_examples["end_positions"] = []
-
-    for i, offsets in enumerate(offset_mapping):
-        # We will label impossible answers with the index of the CLS token.
-        input_ids = tokenized_examples["input_ids"][i]
-        cls_index = input_ids.index(tokenizer.cls_token_id)
-
-        # Grab the sequence corresponding to that example (to know what is the context and what
-        # is the question).
-        sequence_ids = tokenized_examples.sequence_ids(i)
-
-        # One example can give several spans, this is the index of the example containing this
-        # span of text.
-        sample_index = sample_mapping[i]
-
-        # Start/end character index of the answer in the text.
-        start_char = examples["span_start"][sample_index]
-        end_char = examples["span_end"][sample_index]
-
-        # Start token index of the current span in the text.
-        token_start_index = 0
-        while sequence_ids[token_start_index] != 1:
-            token_start_index += 1
-
-        # End token index of the current span in the text.
-        token_end_index = len(input_ids) - 1
-        while sequence_ids[token_end_index] != 1:
-            token_end_index -= 1
-
-        # Detect if the answer is out of the span (in which case this feature is labeled with the
-        # CLS index).
-        if offsets[token_start_index][0] > start_char or offsets[token_end_index][1] < end_char:
-            tokenized_examples["start_positions"].append(cls_index)
-            tokenized_examples["end_positions"].append(cls_index)
-        else:
-            # Otherwise move the token_start_index and token_end_index to the two ends of the
-            # answer.
-            # Note: we could go after the last offset if the answer is the last word (edge
-            # case).
-            while (
-                token_start_index < len(offsets)
-                and offsets[token_start_index][0] <= start_char
-            ):
+    start_positions, end_positions = _label_spans(offsets, context_mask, start_char, end_char, cls_index)
+    tokenized_examples["start_positions"] = start_positions
+    tokenized_examples["end_positions"] = end_positions
+
+    # Store the features as contiguous arrays of small integers rather than lists of Python ints.
+    tokenized_examples["input_ids"] = np.asarray(tokenized_examples["input_ids"], dtype=np.int32)
+    tokenized_examples["attention_mask"] = np.asarray(tokenized_examples["attention_mask"], dtype=np.uint8)
+
+    return tokenized_examples
+
+
+def _label_spans_numpy(offsets, context_mask, start_char, end_char, cls_index):
+    """Token indices of the start and of the end of the answer for each feature, or
+    ``cls_index`` if the answer is not fully inside the feature.
+
+    All the features are processed at once: ``offsets`` has shape
+    ``(n_features, max_length, 2)``, ``context_mask`` shape ``(n_features, max_length)`` and
+    the other arrays shape ``(n_features,)``.
+    """
+    n_features, max_length = context_mask.shape
+    features = np.arange(n_features)
+    tokens = np.arange(max_length)
+
+    # Start/end token index of the current span in the text.
+    token_start_index = context_mask.argmax(axis=1)
+    token_end_index = max_length - 1 - context_mask[:, ::-1].argmax(axis=1)
+
+    # Detect if the answer is out of the span (in which case this feature is labeled with the
+    # CLS index).
+    out_of_span = (
+        (offsets[features, token_start_index, 0] > start_char)
+        | (offsets[features, token_end_index, 1] < end_char)
+    )
+
+    # Otherwise move the token_start_index and token_end_index to the two ends of the answer.
+    # The offsets are not sorted (question, context and padding follow each other), hence the
+    # masked searches instead of a binary search.
+    # Note: we could go after the last offset if the answer is the last word (edge case).
+    after_start = (tokens >= token_start_index[:, None]) & (offsets[:, :, 0] > start_char[:, None])
+    start_positions = np.where(after_start.any(axis=1), after_start.argmax(axis=1), max_length) - 1
+
+    before_end = (tokens <= token_end_index[:, None]) & (offsets[:, :, 1] < end_char[:, None])
+    end_positions = np.where(
+        before_end.any(axis=1), max_length - 1 - before_end[:, ::-1].argmax(axis=1), -1
+    ) + 1
+
+    return np.where(out_of_span, cls_index, start_positions), np.where(out_of_span, cls_index, end_positions)
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _label_spans_jit(offsets, context_mask, start_char, end_char, cls_index):
+        """Compiled equivalent of ``_label_spans_numpy``. It runs serially: ``tokenize_datasets``
+        already parallelizes over processes, and a whole batch takes well under a millisecond."""
+        n_features, max_length = context_mask.shape
+        start_positions = np.empty(n_features, dtype=np.int64)
+        end_positions = np.empty(n_features, dtype=np.int64)
+
+        for i in range(n_features):
+            # Start/end token index of the current span in the text.
+            token_start_index = 0
+            while not context_mask[i, token_start_index]:
                 token_start_index += 1
-            tokenized_examples["start_positions"].append(token_start_index - 1)
-            while offsets[token_end_index][1] >= end_char:
+
+            token_end_index = max_length - 1
+            while not context_mask[i, token_end_index]:
                 token_end_index -= 1
-            tokenized_examples["end_positions"].append(token_end_index + 1)
 
-    return tokenized_examples
+            if offsets[i, token_start_index, 0] > start_char[i] or offsets[i, token_end_index, 1] < end_char[i]:
+                start_positions[i] = cls_index[i]
+                end_positions[i] = cls_index[i]
+            else:
+                while token_start_index < max_length and offsets[i, token_start_index, 0] <= start_char[i]:
+                    token_start_index += 1
+                start_positions[i] = token_start_index - 1
+                while token_end_index >= 0 and offsets[i, token_end_index, 1] >= end_char[i]:
+                    token_end_index -= 1
+                end_positions[i] = token_end_index + 1
+
+        return start_positions, end_positions
+
+    _label_spans = _label_spans_jit
+else:
+    _label_spans = _label_spans_numpy
 
 
 def prepare_train_features_sequence_to_sequence(examples, tokenizer, encoder_max_length=380, decoder_max_length=128):
@@ -113,8 +181,10 @@ def prepare_train_features_sequence_to_sequence(examples, tokenizer, encoder_max
     Parameters
     ----------
     examples : datasets.Dataset
-    tokenizer : transformers.PreTrainedTokenizer | transformers.PreTrainedTokenizerFast
-        pretrained tokenizer for the model for which to use the features.
+    tokenizer : transformers.PreTrainedTokenizerFast
+        pretrained tokenizer for the model for which to use the features. It must be a fast
+        (Rust-backed) tokenizer, e.g. loaded with ``AutoTokenizer.from_pretrained(..., use_fast=True)``,
+        passed to ``add_leading_strip`` so that the leading whitespace of the inputs is ignored.
     encoder_max_length : int, optional
         maximum length of the tokenization of the encoder input, by default 380.
     decoder_max_length : int, optional
@@ -130,24 +200,136 @@ def prepare_train_features_sequence_to_sequence(examples, tokenizer, encoder_max
          - ``'decoder_attention_mask'``
          - ``'labels'``
     """
-    question = [q.lstrip() for q in examples["question"]]
-    story = [c.lstrip() for c in examples["story"]]
-    answer = [a.lstrip() for a in examples["answer"]]
+    assert tokenizer.is_fast, "a fast tokenizer is required"
 
-    # tokenize the inputs and story
-    tokenized_inputs = tokenizer(question, story, truncation="only_second", max_length=encoder_max_length, padding="max_length")
+    # tokenize the inputs and story. The encoder and the decoder have different maximum lengths,
+    # which a single call with ``text_target`` cannot express. The token type ids are not needed.
+    tokenized_inputs = tokenizer(examples["question"], examples["story"], truncation="only_second", max_length=encoder_max_length, padding="max_length", return_token_type_ids=False)
 
     # tokenize the answers
-    tokenized_outputs = tokenizer(answer, truncation=True, max_length=decoder_max_length, padding="max_length")
+    tokenized_outputs = tokenizer(examples["answer"], truncation=True, max_length=decoder_max_length, padding="max_length", return_token_type_ids=False)
 
-    examples["input_ids"] = tokenized_inputs.input_ids
-    examples["attention_mask"] = tokenized_inputs.attention_mask
-    examples["decoder_input_ids"] = tokenized_outputs.input_ids
-    examples["decoder_attention_mask"] = tokenized_outputs.attention_mask
-    examples["labels"] = tokenized_outputs.input_ids.copy()
+    # store the features as contiguous arrays of small integers rather than lists of Python ints
+    decoder_input_ids = np.asarray(tokenized_outputs.input_ids, dtype=np.int32)
+    examples["input_ids"] = np.asarray(tokenized_inputs.input_ids, dtype=np.int32)
+    examples["attention_mask"] = np.asarray(tokenized_inputs.attention_mask, dtype=np.uint8)
+    examples["decoder_input_ids"] = decoder_input_ids
+    examples["decoder_attention_mask"] = np.asarray(tokenized_outputs.attention_mask, dtype=np.uint8)
 
     # because BERT automatically shifts the labels, the labels correspond exactly to `decoder_input_ids`. 
-    # We have to make sure that the PAD token is ignored
-    examples["labels"] = [[-100 if token == tokenizer.pad_token_id else token for token in labels] for labels in examples["labels"]]
+    # We have to make sure that the PAD token is ignored. The labels stay int64, as the loss
+    # requires.
+    labels = np.where(decoder_input_ids == tokenizer.pad_token_id, -100, decoder_input_ids)
+    examples["labels"] = labels.astype(np.int64)
 
     return examples
+
+
+def add_leading_strip(tokenizer):
+    """Let the Rust backend of ``tokenizer`` strip the leading whitespace of its inputs, so that
+    the preprocessing functions do not have to do it in Python. The offsets still refer to the
+    original text.
+
+    Call it once, right after loading the tokenizer: the tokenizer is modified in place, and
+    the change is kept by ``save_pretrained``.
+
+    Parameters
+    ----------
+    tokenizer : transformers.PreTrainedTokenizerFast
+    """
+    backend = tokenizer.backend_tokenizer
+    strip = normalizers.Strip(left=True, right=False)
+    if backend.normalizer is None:
+        backend.normalizer = strip
+    else:
+        backend.normalizer = normalizers.Sequence([strip, backend.normalizer])
+
+
+def tokenize_datasets(datasets, prepare_features, tokenizer, batch_size=1000, num_proc=None,
+                      cache_dir=None, training_args=None, **kwargs):
+    """Apply one of the feature preparation functions to every split of ``datasets``, removing
+    the original columns.
+
+    The results are cached by ``datasets`` under a deterministic fingerprint, so that
+    subsequent runs with the same data, tokenizer and parameters skip the preprocessing.
+
+    Parameters
+    ----------
+    datasets : datasets.DatasetDict
+    prepare_features : callable
+        ``prepare_train_features_span`` or ``prepare_train_features_sequence_to_sequence``.
+    tokenizer : transformers.PreTrainedTokenizerFast
+        pretrained tokenizer for the model for which to use the features.
+    batch_size : int, optional
+        number of examples passed at once to ``prepare_features``, by default 1000.
+    num_proc : int, optional
+        number of processes used for the preprocessing, by default ``os.cpu_count()``.
+    cache_dir : str, optional
+        folder in which the tokenized splits are cached as Arrow files. It is needed for
+        datasets that live in memory (e.g. created with ``Dataset.from_pandas``), which
+        ``datasets`` does not cache on its own. By default, the cache of ``datasets`` is used.
+    training_args : transformers.TrainingArguments, optional
+        if given, the main process tokenizes first and the other processes load its cache.
+    **kwargs
+        additional parameters of ``prepare_features``, e.g. ``max_length``.
+
+    Returns
+    -------
+    datasets.DatasetDict
+        tokenized datasets.
+    """
+    if num_proc is None:
+        num_proc = os.cpu_count()
+    if num_proc > 1:
+        # the fast tokenizer is already multithreaded, do not oversubscribe the cores
+        os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    function = partial(prepare_features, tokenizer=tokenizer, **kwargs)
+
+    if training_args is not None:
+        context = training_args.main_process_first()
+    else:
+        context = contextlib.nullcontext()
+
+    tokenized_datasets = {}
+    with context:
+        for split, dataset in datasets.items():
+            fingerprint = _fingerprint(dataset, prepare_features, tokenizer, kwargs)
+            if cache_dir is not None:
+                cache_file_name = os.path.join(cache_dir, f"{split}-{fingerprint}.arrow")
+            else:
+                cache_file_name = None
+
+            tokenized_datasets[split] = dataset.map(
+                function,
+                batched=True,
+                batch_size=batch_size,
+                num_proc=num_proc,
+                remove_columns=dataset.column_names,
+                load_from_cache_file=True,
+                keep_in_memory=False,
+                cache_file_name=cache_file_name,
+                new_fingerprint=fingerprint,
+            )
+
+    return DatasetDict(tokenized_datasets)
+
+
+def _fingerprint(dataset, prepare_features, tokenizer, kwargs):
+    """Fingerprint of the tokenized dataset, depending only on the input dataset and on the
+    preprocessing: the code of ``prepare_features`` and of this module (which holds the
+    helpers it calls), the full state of the tokenizer (e.g. its normalizer) and the
+    parameters."""
+    with open(__file__, "rb") as f:
+        module_hash = hashlib.sha256(f.read()).hexdigest()
+
+    key = "|".join([
+        dataset._fingerprint,
+        Hasher.hash(prepare_features),
+        module_hash,
+        Hasher.hash(tokenizer),
+        repr(sorted(kwargs.items())),
+    ])
+    return hashlib.sha256(key.encode()).hexdigest()